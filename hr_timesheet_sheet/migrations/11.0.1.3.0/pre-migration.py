@@ -0,0 +1,18 @@
+# Copyright 2018 Eficent Business and IT Consulting Services, S.L.
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo.tools.sql import column_exists, create_column
+
+
+def migrate(cr, version):
+    """Fill the new stored sheet_state column of the analytic lines in SQL,
+    so that the ORM does not recompute it line by line."""
+    if not version:
+        return
+    if not column_exists(cr, 'account_analytic_line', 'sheet_state'):
+        create_column(cr, 'account_analytic_line', 'sheet_state', 'varchar')
+    cr.execute("""
+        UPDATE account_analytic_line l
+        SET sheet_state = s.state
+        FROM hr_timesheet_sheet s
+        WHERE s.id = l.sheet_id""")
@@ -3,6 +3,8 @@
 
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
+from odoo.osv import expression
+from odoo.tools import split_every
 
 
 class AccountAnalyticLine(models.Model):
@@ -22,44 +24,105 @@ class AccountAnalyticLine(models.Model):
         compute='_compute_sheet',
         store=True,
     )
+    sheet_state = fields.Selection([
+        ('draft', 'Open'),
+        ('confirm', 'Waiting Approval'),
+        ('done', 'Approved')],
+        string='Sheet Status',
+        compute='_compute_sheet_state',
+        store=True,
+        index=True,
+    )
+
+    @api.depends('sheet_id')
+    def _compute_sheet_state(self):
+        """State changes of the sheets are propagated in bulk by
+        hr_timesheet.sheet._update_timesheets_sheet_state()"""
+        for timesheet in self:
+            timesheet.sheet_state = timesheet.sheet_id.state
 
     @api.depends('date', 'user_id', 'project_id', 'task_id', 'company_id',
                  'sheet_id.date_start', 'sheet_id.date_end',
                  'sheet_id.employee_id', 'sheet_id.company_id')
     def _compute_sheet(self):
         """Links the timesheet line to the corresponding sheet"""
-        for timesheet in self:
-            if timesheet.sheet_id or not timesheet.project_id:
-                continue
-            sheets = self.env['hr_timesheet.sheet'].search(
-                [('date_end', '>=', timesheet.date),
-                 ('date_start', '<=', timesheet.date),
-                 ('employee_id.user_id.id', '=', timesheet.user_id.id),
-                 ('company_id', 'in', [timesheet.company_id.id, False]),
-                 ('state', '=', 'draft'),
-                 ])
-            if sheets:
-                timesheet.sheet_id_computed = sheets[0]
-                timesheet.sheet_id = sheets[0]
+        timesheets = self.filtered(
+            lambda t: not t.sheet_id and t.project_id)
+        sheets = self._get_sheets_by_key(set(
+            (t.user_id.id, t.company_id.id or None, t.date)
+            for t in timesheets))
+        for timesheet in timesheets:
+            sheet = sheets.get((timesheet.user_id.id,
+                                timesheet.company_id.id or None,
+                                timesheet.date))
+            if sheet:
+                timesheet.sheet_id_computed = sheet
+                timesheet.sheet_id = sheet
 
-    def _search_sheet(self, operator, value):
-        assert operator == 'in'
-        ids = []
-        for ts in self.env['hr_timesheet.sheet'].browse(value):
+    @api.model
+    def _get_sheets_by_key(self, keys):
+        """Resolve (user_id, company_id, date) keys against the draft sheets
+        with a range join per chunk of keys. Returns a dict mapping each key
+        to the most recent matching sheet."""
+        Sheet = self.env['hr_timesheet.sheet']
+        keys = [key for key in keys if key[0] and key[2]]
+        if not keys:
+            return {}
+        rows = []
+        for chunk in split_every(1000, keys):
             self._cr.execute("""
-                    SELECT l.id
-                        FROM account_analytic_line l
-                    WHERE %(date_end)s >= l.date
-                        AND %(date_start)s <= l.date
-                        AND %(user_id)s = l.user_id
-                        AND %(company_id)s = l.company_id
-                    GROUP BY l.id""", {'date_start': ts.date_start,
-                                       'date_end': ts.date_end,
-                                       'user_id': ts.employee_id.user_id.id,
-                                       'company_id': ts.company_id.id,
-                                       })
-            ids.extend([row[0] for row in self._cr.fetchall()])
-        return [('id', 'in', ids)]
+                SELECT DISTINCT ON (k.user_id, k.company_id, k.date)
+                    k.user_id, k.company_id, k.date, s.id
+                FROM (VALUES {}) AS k(user_id, company_id, date)
+                JOIN hr_timesheet_sheet s
+                    ON s.user_id = k.user_id
+                    AND s.date_start <= k.date
+                    AND s.date_end >= k.date
+                    AND (s.company_id = k.company_id OR s.company_id IS NULL)
+                WHERE s.state = 'draft'
+                ORDER BY k.user_id, k.company_id, k.date, s.id DESC""".format(
+                ', '.join(
+                    ['(%s::integer, %s::integer, %s::date)'] * len(chunk))),
+                [value for key in chunk for value in key])
+            rows += self._cr.fetchall()
+        # apply the access rules of the sheets, like a search would
+        sheets = Sheet.search([('id', 'in', list(set(r[3] for r in rows)))])
+        allowed_ids = set(sheets.ids)
+        return {
+            (user_id, company_id, fields.Date.to_string(date)):
+                sheets.browse(sheet_id).with_prefetch(sheets._prefetch)
+            for user_id, company_id, date, sheet_id in rows
+            if sheet_id in allowed_ids
+        }
+
+    def _search_sheet(self, operator, value):
+        """Search the lines falling in the range of the given sheets with a
+        subquery, so that the database handles any number of sheets."""
+        if operator not in ('in', 'not in', '=', '!='):
+            raise UserError(_('Operation not supported'))
+        query = """
+            SELECT l.id
+            FROM account_analytic_line l
+            JOIN hr_timesheet_sheet s
+                ON s.date_start <= l.date
+                AND s.date_end >= l.date
+                AND s.user_id = l.user_id
+                AND s.company_id IS NOT DISTINCT FROM l.company_id"""
+        negate = operator in ('not in', '!=')
+        if value is False and operator in ('=', '!='):
+            # lines (not) covered by any sheet
+            negate = not negate
+            params = ()
+        else:
+            ids = value if isinstance(value, (list, tuple)) else [value]
+            ids = [sheet_id for sheet_id in ids if sheet_id]
+            if not ids:
+                return expression.TRUE_DOMAIN if negate \
+                    else expression.FALSE_DOMAIN
+            query += " WHERE s.id IN %s"
+            params = (tuple(ids),)
+        return [('id', 'not inselect' if negate else 'inselect',
+                 (query, params))]
 
     @api.multi
     def write(self, values):
@@ -74,14 +137,43 @@ class AccountAnalyticLine(models.Model):
     @api.multi
     def _check_state_on_write(self, values):
         """ Hook for extensions """
-        self._check_state()
+        if set(values) & set(self._get_sheet_protected_fields()):
+            self._check_state()
+
+    @api.model
+    def _get_sheet_protected_fields(self):
+        """Fields that cannot be written on the lines of a confirmed sheet.
+        Can be configured with the 'hr_timesheet_sheet.protected_fields'
+        system parameter, as a comma-separated list of field names."""
+        param = self.env['ir.config_parameter'].sudo().get_param(
+            'hr_timesheet_sheet.protected_fields')
+        if param:
+            return [name.strip() for name in param.split(',')]
+        return [
+            'name',
+            'date',
+            'unit_amount',
+            'account_id',
+            'project_id',
+            'task_id',
+            'employee_id',
+            'user_id',
+            'company_id',
+            'sheet_id',
+        ]
 
     @api.multi
     def _check_state(self):
         if self.env.context.get('skip_check_state'):
             return
-        for line in self:
-            if line.sheet_id and line.sheet_id.state != 'draft':
+        for sub_ids in self.env.cr.split_for_in_conditions(self.ids):
+            self.env.cr.execute("""
+                SELECT 1
+                FROM account_analytic_line
+                WHERE id IN %s
+                    AND sheet_state != 'draft'
+                LIMIT 1""", (sub_ids,))
+            if self.env.cr.fetchone():
                 raise UserError(
                     _('You cannot modify an entry in a confirmed '
                       'timesheet sheet.'))
@@ -97,3 +189,46 @@ class AccountAnalyticLine(models.Model):
         })
         self[1:].unlink()
         return self[0]
+
+    @api.model
+    def merge_sheet_timesheets(self, sheets):
+        """Merge the duplicate '/' timesheets of every cell of the given
+        draft sheets at once: the amounts of each group are summed on its
+        last timesheet with a single grouped UPDATE, and the others are
+        deleted. Returns the merged timesheets."""
+        if not sheets.ids:
+            return self.browse()
+        self.env.cr.execute("""
+            UPDATE account_analytic_line l
+            SET unit_amount = g.unit_amount,
+                amount = g.amount,
+                write_uid = %(uid)s,
+                write_date = now() at time zone 'UTC'
+            FROM (
+                SELECT MAX(id) AS id, array_agg(id) AS ids,
+                    SUM(COALESCE(unit_amount, 0)) AS unit_amount,
+                    SUM(COALESCE(amount, 0)) AS amount
+                FROM account_analytic_line
+                WHERE sheet_id IN %(sheet_ids)s
+                    AND sheet_state = 'draft'
+                    AND name = '/'
+                GROUP BY sheet_id, date, project_id, task_id
+                HAVING COUNT(*) > 1
+            ) g
+            WHERE l.id = g.id
+            RETURNING g.id, g.ids""", {
+            'uid': self.env.uid,
+            'sheet_ids': tuple(sheets.ids),
+        })
+        rows = self.env.cr.fetchall()
+        merged = self.browse([row[0] for row in rows])
+        merged.invalidate_cache(['unit_amount', 'amount'], merged.ids)
+        merged.modified(['unit_amount', 'amount'])
+        to_unlink = [
+            timesheet_id for merged_id, timesheet_ids in rows
+            for timesheet_id in timesheet_ids if timesheet_id != merged_id]
+        for chunk in split_every(1000, to_unlink):
+            self.browse(chunk).unlink()
+        if self.env.recompute and self.env.context.get('recompute', True):
+            self.recompute()
+        return merged
@@ -28,18 +28,26 @@ class HrDepartment(models.Model):
 
     @api.constrains('company_id')
     def _check_company_id(self):
-        for rec in self.sudo():
-            if not rec.company_id:
-                continue
-            for field in [rec.env['hr_timesheet.sheet'].search([
-                ('department_id', '=', rec.id),
-                ('company_id', '!=', rec.company_id.id),
-                ('company_id', '!=', False),
-            ], limit=1)]:
-                if rec.company_id and field.company_id and \
-                        rec.company_id != field.company_id:
-                    raise ValidationError(_(
-                        'You cannot change the company, as this %s (%s) '
-                        'is assigned to %s (%s).'
-                    ) % (rec._name, rec.display_name,
-                         field._name, field.display_name))
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (r.id) r.id, s.id
+            FROM hr_department r
+            JOIN hr_timesheet_sheet s
+                ON s.department_id = r.id
+                AND s.company_id != r.company_id
+            WHERE r.id IN %s
+            ORDER BY r.id, s.id""", (tuple(self.ids),))
+        rows = self.env.cr.fetchall()
+        if rows:
+            Sheet = self.env['hr_timesheet.sheet'].sudo()
+            messages = []
+            for rec_id, sheet_id in rows:
+                rec = self.sudo().browse(rec_id)
+                field = Sheet.browse(sheet_id)
+                messages.append(_(
+                    'You cannot change the company, as this %s (%s) '
+                    'is assigned to %s (%s).'
+                ) % (rec._name, rec.display_name,
+                     field._name, field.display_name))
+            raise ValidationError('\n'.join(messages))
@@ -1,13 +1,13 @@
 # Copyright 2018 Eficent Business and IT Consulting Services, S.L.
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-import logging
+from collections import OrderedDict, defaultdict
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import (MONTHLY, WEEKLY)
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
-
-_logger = logging.getLogger(__name__)
+from odoo.tools import split_every
+from odoo.tools.sql import create_index
 
 
 class Sheet(models.Model):
@@ -19,34 +19,42 @@ class Sheet(models.Model):
 
     def _default_date_start(self):
         user = self.env['res.users'].browse(self.env.uid)
-        r = user.company_id and user.company_id.sheet_range or WEEKLY
         today = fields.Date.from_string(fields.Date.context_today(self))
+        return self._get_period_start(user.company_id, today)
+
+    def _default_date_end(self):
+        user = self.env['res.users'].browse(self.env.uid)
+        today = fields.Date.from_string(fields.Date.context_today(self))
+        return self._get_period_end(user.company_id, today)
+
+    @api.model
+    def _get_period_start(self, company, date):
+        r = company and company.sheet_range or WEEKLY
         if r == WEEKLY:
-            if user.company_id.timesheet_week_start:
+            if company.timesheet_week_start:
                 delta = relativedelta(
-                    weekday=int(user.company_id.timesheet_week_start),
+                    weekday=int(company.timesheet_week_start),
                     days=6)
             else:
-                delta = relativedelta(days=today.weekday())
-            return today - delta
+                delta = relativedelta(days=date.weekday())
+            return date - delta
         elif r == MONTHLY:
-            return today + relativedelta(day=1)
-        return today
+            return date + relativedelta(day=1)
+        return date
 
-    def _default_date_end(self):
-        user = self.env['res.users'].browse(self.env.uid)
-        r = user.company_id and user.company_id.sheet_range or WEEKLY
-        today = fields.Date.from_string(fields.Date.context_today(self))
+    @api.model
+    def _get_period_end(self, company, date):
+        r = company and company.sheet_range or WEEKLY
         if r == WEEKLY:
-            if user.company_id.timesheet_week_start:
+            if company.timesheet_week_start:
                 delta = relativedelta(weekday=(int(
-                    user.company_id.timesheet_week_start) + 6) % 7)
+                    company.timesheet_week_start) + 6) % 7)
             else:
-                delta = relativedelta(days=6-today.weekday())
-            return today + delta
+                delta = relativedelta(days=6-date.weekday())
+            return date + delta
         elif r == MONTHLY:
-            return today + relativedelta(months=1, day=1, days=-1)
-        return today
+            return date + relativedelta(months=1, day=1, days=-1)
+        return date
 
     def _default_employee(self):
         emp_ids = self.env['hr.employee'].search(
@@ -140,10 +148,74 @@ class Sheet(models.Model):
         store=True,
     )
 
+    @api.model_cr
+    def init(self):
+        # used by the overlap check between the sheets of a user
+        create_index(
+            self.env.cr, 'hr_timesheet_sheet_overlap_index', self._table,
+            ['user_id', 'company_id', 'date_start', 'date_end'])
+
     @api.depends('timesheet_ids.unit_amount')
     def _compute_total_time(self):
+        if self.env.in_onchange or not all(self.ids):
+            for sheet in self:
+                sheet.total_time = sum(
+                    sheet.mapped('timesheet_ids.unit_amount'))
+            return
+        # stored lines are up to date: sum them up for all sheets at once
+        totals = self._get_total_times()
         for sheet in self:
-            sheet.total_time = sum(sheet.mapped('timesheet_ids.unit_amount'))
+            sheet.total_time = totals.get(sheet.id, 0.0)
+
+    @api.multi
+    def _get_total_times(self):
+        if not self.ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT sheet_id, SUM(unit_amount)
+            FROM account_analytic_line
+            WHERE sheet_id IN %s
+            GROUP BY sheet_id""", (tuple(self.ids),))
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def rebuild_total_time(self, sheet_ids=None):
+        """Recompute the total time of the given sheets, or of all sheets,
+        with a single UPDATE."""
+        query = """
+            UPDATE hr_timesheet_sheet s
+            SET total_time = t.total_time
+            FROM (
+                SELECT s2.id, COALESCE(SUM(l.unit_amount), 0) AS total_time
+                FROM hr_timesheet_sheet s2
+                LEFT JOIN account_analytic_line l ON l.sheet_id = s2.id
+                {where}
+                GROUP BY s2.id
+            ) t
+            WHERE t.id = s.id
+                AND s.total_time IS DISTINCT FROM t.total_time"""
+        if sheet_ids is None:
+            self.env.cr.execute(query.format(where=''))
+        elif sheet_ids:
+            self.env.cr.execute(
+                query.format(where='WHERE s2.id IN %s'), (tuple(sheet_ids),))
+        self.invalidate_cache(['total_time'], sheet_ids)
+
+    @api.multi
+    def _update_timesheets_sheet_state(self):
+        """Copy the state of the sheets on their timesheets with a single
+        UPDATE."""
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            UPDATE account_analytic_line l
+            SET sheet_state = s.state
+            FROM hr_timesheet_sheet s
+            WHERE s.id = l.sheet_id
+                AND s.id IN %s
+                AND l.sheet_state IS DISTINCT FROM s.state""",
+                            (tuple(self.ids),))
+        self.env['account.analytic.line'].invalidate_cache(['sheet_state'])
 
     @api.constrains('date_start', 'date_end')
     def _check_start_end_dates(self):
@@ -154,78 +226,71 @@ class Sheet(models.Model):
 
     @api.constrains('date_start', 'date_end', 'employee_id')
     def _check_sheet_date(self, forced_user_id=False):
-        for sheet in self:
-            new_user_id = forced_user_id or sheet.user_id and sheet.user_id.id
-            if new_user_id:
-                self.env.cr.execute(
-                    """
-                    SELECT id
-                    FROM hr_timesheet_sheet
-                    WHERE (date_start <= %s and %s <= date_end)
-                        AND user_id=%s
-                        AND company_id=%s
-                        AND id <> %s""",
-                    (sheet.date_end, sheet.date_start, new_user_id,
-                     sheet.company_id.id, sheet.id))
-                if any(self.env.cr.fetchall()):
-                    raise ValidationError(
-                        _('You cannot have 2 sheets that overlap!\n'
-                          'Please use the menu \'Timesheet Sheet\' '
-                          'to avoid this problem.'))
-
-    @api.multi
-    @api.constrains('company_id', 'employee_id')
-    def _check_company_id_employee_id(self):
-        for rec in self.sudo():
-            if rec.company_id and rec.employee_id.company_id and \
-                    rec.company_id != rec.employee_id.company_id:
-                raise ValidationError(
-                    _('The Company in the Timesheet Sheet and in '
-                      'the Employee must be the same.'))
-
-    @api.multi
-    @api.constrains('company_id', 'department_id')
-    def _check_company_id_department_id(self):
-        for rec in self.sudo():
-            if rec.company_id and rec.department_id.company_id and \
-                    rec.company_id != rec.department_id.company_id:
-                raise ValidationError(
-                    _('The Company in the Timesheet Sheet and in '
-                      'the Department must be the same.'))
+        if not self.ids:
+            return
+        self.env.cr.execute(
+            """
+            SELECT s1.id
+            FROM hr_timesheet_sheet s1
+            JOIN hr_timesheet_sheet s2
+                ON s2.user_id = COALESCE(%s, s1.user_id)
+                AND s2.company_id = s1.company_id
+                AND s2.date_start <= s1.date_end
+                AND s1.date_start <= s2.date_end
+                AND s2.id <> s1.id
+            WHERE s1.id IN %s
+            LIMIT 1""",
+            (forced_user_id or None, tuple(self.ids)))
+        if any(self.env.cr.fetchall()):
+            raise ValidationError(
+                _('You cannot have 2 sheets that overlap!\n'
+                  'Please use the menu \'Timesheet Sheet\' '
+                  'to avoid this problem.'))
 
     @api.multi
-    @api.constrains('company_id', 'add_line_project_id')
-    def _check_company_id_add_line_project_id(self):
-        for rec in self.sudo():
-            if rec.company_id and rec.add_line_project_id.company_id and \
-                    rec.company_id != rec.add_line_project_id.company_id:
-                raise ValidationError(
-                    _('The Company in the Timesheet Sheet and in '
-                      'the Project must be the same.'))
-
-    @api.multi
-    @api.constrains('company_id', 'add_line_task_id')
-    def _check_company_id_add_line_task_id(self):
-        for rec in self.sudo():
-            if rec.company_id and rec.add_line_task_id.company_id and \
-                    rec.company_id != rec.add_line_task_id.company_id:
-                raise ValidationError(
-                    _('The Company in the Timesheet Sheet and in '
-                      'the Task must be the same.'))
+    @api.constrains('company_id', 'employee_id', 'department_id',
+                    'add_line_project_id', 'add_line_task_id')
+    def _check_company_id_fields(self):
+        sheets = self.sudo()
+        fields_to_check = [
+            ('employee_id', _('The Company in the Timesheet Sheet and in '
+                              'the Employee must be the same.')),
+            ('department_id', _('The Company in the Timesheet Sheet and in '
+                                'the Department must be the same.')),
+            ('add_line_project_id', _('The Company in the Timesheet Sheet '
+                                      'and in the Project must be the same.')),
+            ('add_line_task_id', _('The Company in the Timesheet Sheet and in '
+                                   'the Task must be the same.')),
+        ]
+        # read the companies of all the related records at once
+        for field_name, __ in fields_to_check:
+            sheets.mapped(field_name + '.company_id')
+        for rec in sheets.filtered('company_id'):
+            for field_name, message in fields_to_check:
+                company = rec[field_name].company_id
+                if company and rec.company_id != company:
+                    raise ValidationError(message)
 
     @api.constrains('company_id')
     def _check_company_id(self):
-        for rec in self.sudo():
-            if not rec.company_id:
-                continue
-            for field in rec.timesheet_ids:
-                if rec.company_id and field.company_id and \
-                        rec.company_id != field.company_id:
-                    raise ValidationError(_(
-                        'You cannot change the company, as this %s (%s) '
-                        'is assigned to %s (%s).'
-                    ) % (rec._name, rec.display_name,
-                         field._name, field.display_name))
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            SELECT s.id, l.id
+            FROM hr_timesheet_sheet s
+            JOIN account_analytic_line l ON l.sheet_id = s.id
+            WHERE s.id IN %s
+                AND l.company_id != s.company_id
+            LIMIT 1""", (tuple(self.ids),))
+        res = self.env.cr.fetchone()
+        if res:
+            rec = self.sudo().browse(res[0])
+            field = self.env['account.analytic.line'].sudo().browse(res[1])
+            raise ValidationError(_(
+                'You cannot change the company, as this %s (%s) '
+                'is assigned to %s (%s).'
+            ) % (rec._name, rec.display_name,
+                 field._name, field.display_name))
 
     @api.onchange('employee_id')
     def _onchange_employee_id(self):
@@ -235,44 +300,291 @@ class Sheet(models.Model):
 
     @api.multi
     def _compute_line_ids(self):
+        SheetLine = self.env['hr_timesheet.sheet.line']
         for sheet in self:
-            if not all([sheet.date_start, sheet.date_end]):
-                continue
-            dates = sheet._get_dates()
-            if not dates:
-                continue
-            timesheets = self.env['account.analytic.line'].search([
-                ('project_id', '!=', False),
-                ('date', '<=', sheet.date_end),
-                ('date', '>=', sheet.date_start),
-                ('employee_id', '=', sheet.employee_id.id),
-                ('sheet_id', 'in', [sheet and sheet.id or False, False]),
-                ('company_id', '=', sheet.company_id.id),
-            ])
-            lines = self.env['hr_timesheet.sheet.line']
+            sheet.line_ids = SheetLine._create_bulk(sheet._get_line_values())
+
+    @api.multi
+    def _get_line_values(self):
+        """Return the values of every cell of the matrix"""
+        return self._get_matrix_values()[0]
+
+    @api.multi
+    def _get_matrix_values(self):
+        """Return the values of the cells of the matrix, restricted to the
+        window requested in the context if any, and the number of rows of
+        the whole matrix."""
+        self.ensure_one()
+        if not all([self.date_start, self.date_end]):
+            return [], 0
+        dates = self._get_dates()
+        if not dates:
+            return [], 0
+        values = []
+        if self.state == 'draft':
+            if self._has_matrix_window():
+                # only load the timesheets of the requested window
+                all_rows = self._get_matrix_rows(
+                    self._get_timesheet_matrix_keys())
+                rows, dates = self._get_matrix_window(all_rows, dates)
+                __, matrix = self._get_data_matrix(
+                    self._search_matrix_timesheets(rows, dates))
+            else:
+                timesheets = self.env['account.analytic.line'].search(
+                    self._get_timesheet_sheet_lines_domain())
+                all_rows, matrix = self._get_data_matrix(timesheets)
+                rows = all_rows
+            empty = self.env['account.analytic.line']
             for date in dates:
-                for project in timesheets.mapped('project_id'):
-                    timesheet = timesheets.filtered(
-                        lambda x: (x.project_id == project))
-                    tasks = [task for task in timesheet.mapped('task_id')]
-                    if not timesheet or not all(
-                            [t.task_id for t in timesheet]):
-                        tasks += [self.env['project.task']]
-                    for task in tasks:
-                        lines |= self.env['hr_timesheet.sheet.line'].create(
-                            sheet._get_default_analytic_line(
-                                date=date,
-                                project=project,
-                                task=task,
-                                timesheet=timesheet.filtered(
-                                    lambda t: date == t.date
-                                    and t.task_id.id == task.id),
-                            ))
-            sheet.line_ids = lines
+                for project, task in rows:
+                    key = self._get_matrix_key(date, project, task)
+                    values.append(self._get_default_analytic_line(
+                        date=date,
+                        project=project,
+                        task=task,
+                        timesheet=matrix.get(key, empty),
+                    ))
+        else:
+            # a locked sheet has no unlinked timesheets: aggregate in SQL
+            data = self._get_timesheet_matrix_data()
+            all_rows = self._get_matrix_rows(data)
+            rows, dates = self._get_matrix_window(all_rows, dates)
+            for date in dates:
+                for project, task in rows:
+                    key = self._get_matrix_key(date, project, task)
+                    unit_amount, count = data.get(key, (0.0, 0))
+                    values.append(self._get_sheet_line_values(
+                        date, project, task, unit_amount, count))
+        return values, len(all_rows)
+
+    def _has_matrix_window(self):
+        ctx = self.env.context
+        return any(ctx.get(key) for key in [
+            'matrix_row_offset',
+            'matrix_row_limit',
+            'matrix_date_offset',
+            'matrix_date_limit',
+        ])
+
+    def _get_matrix_window(self, rows, dates):
+        """Restrict the matrix to the window of rows and dates requested
+        in the context, if any, so that long sheets can be loaded
+        progressively."""
+        ctx = self.env.context
+        row_offset = ctx.get('matrix_row_offset') or 0
+        row_limit = ctx.get('matrix_row_limit')
+        date_offset = ctx.get('matrix_date_offset') or 0
+        date_limit = ctx.get('matrix_date_limit')
+        rows = rows[row_offset:]
+        if row_limit:
+            rows = rows[:row_limit]
+        dates = dates[date_offset:]
+        if date_limit:
+            dates = dates[:date_limit]
+        return rows, dates
+
+    @api.multi
+    def read_matrix_window(self, row_offset=0, row_limit=None,
+                           date_offset=0, date_limit=None,
+                           field_names=None):
+        """Return the values of the cells of one window of the matrix
+        together with the total number of rows and dates of the sheet, for
+        clients paging through the matrix instead of loading it at once."""
+        self.ensure_one()
+        sheet = self.with_context(
+            matrix_row_offset=row_offset,
+            matrix_row_limit=row_limit,
+            matrix_date_offset=date_offset,
+            matrix_date_limit=date_limit,
+        )
+        values, row_count = sheet._get_matrix_values()
+        if field_names:
+            values = [{name: vals.get(name) for name in field_names}
+                      for vals in values]
+        return {
+            'lines': values,
+            'row_count': row_count,
+            'date_count': len(self._get_dates()),
+        }
+
+    @api.multi
+    def _get_timesheet_matrix_keys(self):
+        """Return the (date, project, task) keys of the timesheets of the
+        sheet readable by the user, ordered like the timesheets, most
+        recent first, without loading the timesheets."""
+        return list(self._get_timesheet_matrix_data())
+
+    @api.multi
+    def _search_matrix_timesheets(self, rows, dates):
+        """Return the timesheets of the given rows and dates of the sheet"""
+        self.ensure_one()
+        if not rows or not dates:
+            return self.env['account.analytic.line']
+        return self.env['account.analytic.line'].search(
+            self._get_timesheet_sheet_lines_domain() + [
+                ('project_id', 'in',
+                 list(set(project.id for project, __ in rows))),
+                ('date', 'in', dates),
+            ])
+
+    @api.multi
+    def _get_timesheet_sheet_lines_domain(self):
+        self.ensure_one()
+        # within an onchange, a saved sheet is edited through a new record
+        origin = getattr(self, '_origin', None)
+        sheet_id = self.id or origin and origin.id or False
+        return [
+            ('project_id', '!=', False),
+            ('date', '<=', self.date_end),
+            ('date', '>=', self.date_start),
+            ('employee_id', '=', self.employee_id.id),
+            ('sheet_id', 'in', [sheet_id, False]),
+            ('company_id', '=', self.company_id.id),
+        ]
+
+    @api.model
+    def _get_matrix_key(self, date, project, task):
+        return date, project.id, task and task.id or False
+
+    def _get_data_matrix(self, timesheets):
+        """Index the timesheets by (date, project, task) in a single pass.
+        Returns the (project, task) rows of the matrix and a dict mapping
+        each matrix key to its timesheets."""
+        index = OrderedDict()
+        for timesheet in timesheets:
+            key = self._get_matrix_key(
+                timesheet.date, timesheet.project_id, timesheet.task_id)
+            index.setdefault(key, []).append(timesheet.id)
+        matrix = {
+            key: timesheets.browse(ids).with_prefetch(timesheets._prefetch)
+            for key, ids in index.items()
+        }
+        return self._get_matrix_rows(index), matrix
+
+    def _get_matrix_rows(self, keys):
+        """Return the (project, task) rows for the given ordered matrix
+        keys: the tasks of each project in order of first appearance,
+        followed by the project itself if it has timesheets without task."""
+        tasks_by_project = OrderedDict()
+        untasked_project_ids = set()
+        for __, project_id, task_id in keys:
+            task_ids = tasks_by_project.setdefault(project_id, OrderedDict())
+            if task_id:
+                task_ids[task_id] = True
+            else:
+                untasked_project_ids.add(project_id)
+        projects = self.env['project.project'].browse(list(tasks_by_project))
+        tasks = self.env['project.task'].browse(
+            [t for task_ids in tasks_by_project.values() for t in task_ids])
+        rows = []
+        for project in projects:
+            rows += [(project, tasks.browse(task_id).with_prefetch(
+                tasks._prefetch)) for task_id in tasks_by_project[project.id]]
+            if project.id in untasked_project_ids:
+                rows.append((project, self.env['project.task']))
+        return rows
+
+    @api.multi
+    def _get_timesheet_matrix_data(self):
+        """Return the total quantity and the number of timesheets of each
+        (date, project, task) of the sheet, computed by the database over
+        the timesheets readable by the user.
+        Keys are ordered like the timesheets, most recent first."""
+        self.ensure_one()
+        AnalyticLine = self.env['account.analytic.line']
+        AnalyticLine.check_access_rights('read')
+        query = AnalyticLine._where_calc(
+            self._get_timesheet_sheet_lines_domain())
+        AnalyticLine._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        self.env.cr.execute("""
+            SELECT "{table}".date, "{table}".project_id, "{table}".task_id,
+                SUM("{table}".unit_amount), COUNT(*)
+            FROM {from_clause}
+            WHERE {where_clause}
+            GROUP BY 1, 2, 3
+            ORDER BY 1 DESC, MAX("{table}".id) DESC""".format(
+            table=AnalyticLine._table,
+            from_clause=from_clause,
+            where_clause=where_clause or 'TRUE',
+        ), where_params)
+        return OrderedDict(
+            ((fields.Date.to_string(date), project_id, task_id or False),
+             (unit_amount, count))
+            for date, project_id, task_id, unit_amount, count
+            in self.env.cr.fetchall()
+        )
 
     @api.onchange('date_start', 'date_end', 'timesheet_ids')
     def _onchange_dates_or_timesheets(self):
-        self._compute_line_ids()
+        SheetLine = self.env['hr_timesheet.sheet.line']
+        for sheet in self:
+            # reuse the cells already loaded instead of recreating them all
+            lines = sheet.line_ids if 'line_ids' in sheet._cache \
+                else SheetLine
+            keys = sheet._get_matrix_delta_keys(lines)
+            if keys is None:
+                sheet.line_ids = lines._update_or_create(
+                    sheet._get_line_values())
+                continue
+            values, dropped_rows = sheet._get_matrix_delta(lines, keys)
+            sheet.line_ids = lines.filtered(
+                lambda l: l._get_matrix_key()[1:] not in dropped_rows
+            ) | lines._update_or_create(values)
+
+    def _get_matrix_delta_keys(self, lines):
+        """Return the matrix keys affected by the changes made to the
+        timesheets since the sheet was loaded, or None when the whole
+        matrix has to be rebuilt."""
+        origin = getattr(self, '_origin', None)
+        if not lines or not origin or not origin.id:
+            return None
+        if (self.date_start, self.date_end) != \
+                (origin.date_start, origin.date_end):
+            return None
+        current = self._get_timesheets_snapshot(self.timesheet_ids)
+        stored = self._get_timesheets_snapshot(origin.timesheet_ids)
+        return set(item[-3:] for item in current ^ stored)
+
+    def _get_timesheets_snapshot(self, timesheets):
+        return set(
+            (t.id, t.name, t.unit_amount) +
+            self._get_matrix_key(t.date, t.project_id, t.task_id)
+            for t in timesheets if t.project_id)
+
+    def _get_matrix_delta(self, lines, keys):
+        """Recompute only the cells of the given matrix keys.
+        Returns the values of the cells to refresh, including every date
+        of the rows that appeared, and the rows that no longer have any
+        timesheet."""
+        if not keys:
+            return [], set()
+        dates = sorted(set(lines.mapped('date')))
+        project_ids = list(set(key[1] for key in keys))
+        timesheets = self.env['account.analytic.line'].search(
+            self._get_timesheet_sheet_lines_domain() +
+            [('project_id', 'in', project_ids)])
+        rows, matrix = self._get_data_matrix(timesheets)
+        rows = dict(((project.id, task.id or False), (project, task))
+                    for project, task in rows)
+        loaded_rows = set(
+            line._get_matrix_key()[1:] for line in lines
+            if line.project_id.id in project_ids)
+        cells = set(key for key in keys
+                    if key[0] in dates and key[1:] in rows)
+        cells |= set((date,) + row for row in set(rows) - loaded_rows
+                     for date in dates)
+        empty = self.env['account.analytic.line']
+        values = []
+        for key in sorted(cells):
+            project, task = rows[key[1:]]
+            values.append(self._get_default_analytic_line(
+                date=key[0],
+                project=project,
+                task=task,
+                timesheet=matrix.get(key, empty),
+            ))
+        return values, loaded_rows - set(rows)
 
     @api.onchange('add_line_project_id')
     def onchange_add_project_id(self):
@@ -294,6 +606,69 @@ class Sheet(models.Model):
                 },
             }
 
+    @api.model
+    def generate_sheets(self, employees, date=False):
+        """Create the sheets of the period containing ``date`` (today by
+        default) for the given employees, following the sheet range of
+        their company. Employees without user or company, or already
+        having a sheet overlapping the period, are skipped. Existing
+        sheets are looked up as superuser, so that sheets hidden by record
+        rules are not duplicated.
+        Returns the created sheets."""
+        date = fields.Date.from_string(
+            date or fields.Date.context_today(self))
+        employees = employees.filtered(
+            lambda e: e.user_id and e.company_id)
+        periods = {}
+        for employee in employees:
+            company = employee.company_id
+            if company not in periods:
+                periods[company] = (
+                    fields.Date.to_string(
+                        self._get_period_start(company, date)),
+                    fields.Date.to_string(
+                        self._get_period_end(company, date)),
+                )
+        if not periods:
+            return self.browse()
+        existing = defaultdict(list)
+        for sheet in self.sudo().search_read([
+            ('user_id', 'in', employees.mapped('user_id').ids),
+            ('date_start', '<=', max(p[1] for p in periods.values())),
+            ('date_end', '>=', min(p[0] for p in periods.values())),
+        ], ['user_id', 'company_id', 'date_start', 'date_end']):
+            key = (sheet['user_id'] and sheet['user_id'][0],
+                   sheet['company_id'] and sheet['company_id'][0])
+            existing[key].append((sheet['date_start'], sheet['date_end']))
+        vals_list = []
+        for employee in employees:
+            company = employee.company_id
+            date_start, date_end = periods[company]
+            if any(start <= date_end and end >= date_start for start, end
+                   in existing[(employee.user_id.id, company.id)]):
+                continue
+            vals_list.append(
+                self._prepare_generated_sheet(
+                    employee, company, date_start, date_end))
+        return self.create_multi(vals_list)
+
+    @api.model
+    def _prepare_generated_sheet(self, employee, company,
+                                 date_start, date_end):
+        return {
+            'employee_id': employee.id,
+            'company_id': company.id,
+            'department_id': employee.department_id.id,
+            'date_start': date_start,
+            'date_end': date_end,
+        }
+
+    @api.model
+    def _cron_generate_sheets(self):
+        employees = self.env['hr.employee'].search(
+            [('user_id', '!=', False)])
+        self.generate_sheets(employees)
+
     @api.multi
     def copy(self, default=None):
         raise UserError(_('You cannot duplicate a sheet.'))
@@ -306,10 +681,94 @@ class Sheet(models.Model):
                     _('In order to create a sheet for this employee, '
                       'you must link him/her to an user.'))
         res = super(Sheet, self).create(vals)
-        res.write({'state': 'draft'})
-        self.delete_empty_lines(True)
+        if not self.env.context.get('sheet_create_multi'):
+            res._clean_new_sheets()
         return res
 
+    @api.model
+    def create_multi(self, vals_list):
+        """Create several sheets, cleaning up the timesheets they cover
+        once for all of them."""
+        Sheet = self.with_context(sheet_create_multi=True)
+        sheets = self.browse([Sheet.create(vals).id for vals in vals_list])
+        sheets._clean_new_sheets()
+        return sheets
+
+    @api.multi
+    def _clean_new_sheets(self):
+        """Adopt and clean up the timesheets recorded in the range of new
+        sheets. Sheets not covering any timesheet, which is the common
+        case, cost no other query than the one finding them."""
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            SELECT DISTINCT s.id
+            FROM hr_timesheet_sheet s
+            JOIN account_analytic_line l
+                ON l.employee_id = s.employee_id
+                AND l.company_id IS NOT DISTINCT FROM s.company_id
+                AND l.date BETWEEN s.date_start AND s.date_end
+                AND (l.sheet_id IS NULL OR l.sheet_id = s.id)
+            WHERE s.id IN %s
+                AND s.state = 'draft'
+                AND l.project_id IS NOT NULL""", (tuple(self.ids),))
+        sheets = self.browse([r[0] for r in self.env.cr.fetchall()])
+        if not sheets:
+            return
+        sheets.adopt_orphan_timesheets()
+        sheets.delete_empty_lines(True)
+        self.env['account.analytic.line'].merge_sheet_timesheets(sheets)
+
+    @api.multi
+    def adopt_orphan_timesheets(self):
+        """Link the timesheets recorded in the range of the draft sheets
+        that are not linked to any sheet yet, with one UPDATE per sheet
+        restricted by the record rules of the timesheets.
+        Returns the sheets that adopted timesheets."""
+        AnalyticLine = self.env['account.analytic.line']
+        adopted = self.browse()
+        sheets = self.filtered(lambda s: s.id and s.state == 'draft')
+        if sheets:
+            AnalyticLine.check_access_rights('write')
+        for sheet in sheets:
+            query = AnalyticLine._where_calc([
+                ('sheet_id', '=', False),
+                ('project_id', '!=', False),
+                ('employee_id', '=', sheet.employee_id.id),
+                ('company_id', '=', sheet.company_id.id),
+                ('date', '>=', sheet.date_start),
+                ('date', '<=', sheet.date_end),
+            ])
+            AnalyticLine._apply_ir_rules(query, 'write')
+            from_clause, where_clause, where_params = query.get_sql()
+            self.env.cr.execute("""
+                UPDATE account_analytic_line
+                SET sheet_id = %s,
+                    sheet_state = %s,
+                    write_uid = %s,
+                    write_date = now() at time zone 'UTC'
+                WHERE id IN (
+                    SELECT "{table}".id
+                    FROM {from_clause}
+                    WHERE {where_clause})""".format(
+                table=AnalyticLine._table,
+                from_clause=from_clause,
+                where_clause=where_clause or 'TRUE',
+            ), [sheet.id, sheet.state, self.env.uid] + where_params)
+            if self.env.cr.rowcount:
+                adopted |= sheet
+        if adopted:
+            AnalyticLine.invalidate_cache(['sheet_id', 'sheet_state'])
+            adopted.invalidate_cache(['timesheet_ids'], adopted.ids)
+            self.rebuild_total_time(adopted.ids)
+        return adopted
+
+    @api.model
+    def _cron_adopt_orphan_timesheets(self):
+        sheets = self.search([('state', '=', 'draft')])
+        adopted = sheets.adopt_orphan_timesheets()
+        self.env['account.analytic.line'].merge_sheet_timesheets(adopted)
+
     @api.multi
     def write(self, vals):
         if 'employee_id' in vals:
@@ -321,11 +780,43 @@ class Sheet(models.Model):
                       'you must link him/her to an user.'))
             self._check_sheet_date(forced_user_id=new_user_id)
         res = super(Sheet, self).write(vals)
-        if self.state == 'draft':
-            for rec in self:
-                rec.delete_empty_lines(True)
+        if 'state' in vals:
+            self._update_timesheets_sheet_state()
+        adopted = self.browse()
+        if set(vals) & set(self._get_adopt_orphan_timesheets_fields()):
+            adopted = self.adopt_orphan_timesheets()
+        if not self.env.context.get('skip_delete_empty_lines') and \
+                set(vals) & set(self._get_delete_empty_lines_fields()):
+            self.delete_empty_lines(True)
+        if adopted:
+            self.env['account.analytic.line'].merge_sheet_timesheets(adopted)
         return res
 
+    @api.model
+    def _get_adopt_orphan_timesheets_fields(self):
+        """Fields whose change can bring unlinked timesheets in range"""
+        return [
+            'date_start',
+            'date_end',
+            'employee_id',
+            'company_id',
+            'state',
+        ]
+
+    @api.model
+    def _get_delete_empty_lines_fields(self):
+        """Fields whose change can leave empty lines to clean up"""
+        return [
+            'date_start',
+            'date_end',
+            'employee_id',
+            'company_id',
+            'state',
+            'timesheet_ids',
+            'add_line_project_id',
+            'add_line_task_id',
+        ]
+
     @api.multi
     def name_get(self):
         # week number according to ISO 8601 Calendar
@@ -342,13 +833,25 @@ class Sheet(models.Model):
                 raise UserError(
                     _('You cannot delete a timesheet sheet '
                       'which is already confirmed.'))
-        analytic_timesheet_toremove = self.env['account.analytic.line']
-        for sheet in self:
-            analytic_timesheet_toremove += \
-                sheet.timesheet_ids.filtered(lambda t: not t.task_id)
-        analytic_timesheet_toremove.unlink()
+        self._unlink_timesheets_without_task()
         return super(Sheet, self).unlink()
 
+    @api.multi
+    def _unlink_timesheets_without_task(self):
+        """Delete the timesheets without task of the sheets, selected with
+        a single query and unlinked by chunks."""
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            SELECT id
+            FROM account_analytic_line
+            WHERE sheet_id IN %s
+                AND task_id IS NULL""", (tuple(self.ids),))
+        timesheet_ids = [row[0] for row in self.env.cr.fetchall()]
+        AnalyticLine = self.env['account.analytic.line']
+        for chunk in split_every(1000, timesheet_ids):
+            AnalyticLine.browse(chunk).unlink()
+
     @api.multi
     def action_timesheet_draft(self):
         if not self.env.user.has_group('hr_timesheet.group_hr_timesheet_user'):
@@ -390,8 +893,11 @@ class Sheet(models.Model):
         for rec in self:
             if rec.state == 'draft':
                 rec.add_line()
-                rec.add_line_task_id = False
-                rec.add_line_project_id = False
+                # keep the row just added, even though it is still empty
+                rec.with_context(skip_delete_empty_lines=True).write({
+                    'add_line_task_id': False,
+                    'add_line_project_id': False,
+                })
         return True
 
     def _get_date_name(self, date):
@@ -417,26 +923,27 @@ class Sheet(models.Model):
         return name
 
     def _get_default_analytic_line(self, date, project, task, timesheet=None):
-        name_y = self._get_line_name(project, task)
-        timesheet = self.clean_timesheets(timesheet)
+        return self._get_sheet_line_values(
+            date, project, task,
+            unit_amount=sum([t.unit_amount for t in timesheet]),
+            count_timesheets=len(timesheet),
+        )
+
+    def _get_sheet_line_values(self, date, project, task,
+                               unit_amount=0.0, count_timesheets=0):
         values = {
             'value_x': self._get_date_name(date),
-            'value_y': name_y,
+            'value_y': self._get_line_name(project, task),
             'date': date,
             'project_id': project.id,
             'task_id': task and task.id or False,
-            'count_timesheets': len(timesheet),
-            'unit_amount': 0.0,
+            'count_timesheets': count_timesheets,
+            'unit_amount': unit_amount,
         }
         if self.id:
             values.update({
                 'sheet_id': self.id,
             })
-        if timesheet:
-            amount = sum([t.unit_amount for t in timesheet])
-            values.update({
-                'unit_amount': amount,
-            })
         return values
 
     @api.model
@@ -466,36 +973,176 @@ class Sheet(models.Model):
                 self.timesheet_ids |= \
                     self.env['account.analytic.line'].create(values)
 
-    def clean_timesheets(self, timesheet):
-        if self.id:
-            for aal in timesheet.filtered(lambda a: not a.sheet_id):
-                aal.write({'sheet_id': self.id})
-        repeated = timesheet.filtered(lambda t: t.name == "/")
-        if len(repeated) > 1:
-            timesheet = repeated.merge_timesheets()
-        return timesheet
+    @api.multi
+    def apply_matrix_edits(self, cells):
+        """Reconcile the timesheets of the sheet with the quantities entered
+        in several cells of the matrix at once.
 
-    def delete_empty_lines(self, allow_empty_rows=False):
-        for name in self.line_ids.mapped('value_y'):
-            row = self.line_ids.filtered(lambda l: l.value_y == name)
-            if row:
-                task = row[0].task_id and row[0].task_id.id or False
-                ts_row = self.env['account.analytic.line'].search([
-                    ('project_id', '=', row[0].project_id.id),
-                    ('task_id', '=', task),
-                    ('date', '<=', self.date_end),
-                    ('date', '>=', self.date_start),
-                    ('employee_id', '=', self.employee_id.id),
-                    ('sheet_id', '=', self.id),
-                    ('company_id', '=', self.company_id.id),
-                ])
-                if allow_empty_rows and self.add_line_project_id:
-                    check = any([l.unit_amount for l in row])
+        :param cells: list of (date, project_id, task_id, unit_amount)
+        :return: dict mapping each (date, project_id, task_id) key to the
+            number of timesheets of the cell after the edit
+        """
+        self.ensure_one()
+        if self.state != 'draft':
+            raise UserError(
+                _('You cannot modify an entry in a confirmed '
+                  'timesheet sheet.'))
+        AnalyticLine = self.env['account.analytic.line']
+        edits = OrderedDict()
+        for date, project_id, task_id, unit_amount in cells:
+            if not self.date_start <= date <= self.date_end:
+                raise UserError(
+                    _('The date %s is outside of the period of the '
+                      'timesheet sheet.') % date)
+            edits[(date, project_id, task_id or False)] = max(unit_amount, 0.0)
+        if not edits:
+            return {}
+        timesheets = AnalyticLine.search([
+            ('date', 'in', list(set(key[0] for key in edits))),
+            ('project_id', 'in', list(set(key[1] for key in edits))),
+            ('employee_id', '=', self.employee_id.id),
+            ('sheet_id', 'in', [self.id, False]),
+            ('company_id', '=', self.company_id.id),
+        ])
+        # the matrix shows the unlinked timesheets of the range as well
+        if timesheets.filtered(lambda t: not t.sheet_id):
+            self.adopt_orphan_timesheets()
+        __, matrix = self._get_data_matrix(timesheets)
+        amounts = {}
+        to_unlink = []
+        to_create = []
+        counts = {}
+        for key, unit_amount in edits.items():
+            counts[key] = self._reconcile_matrix_cell(
+                key, unit_amount, matrix.get(key, AnalyticLine),
+                amounts, to_unlink, to_create)
+        AnalyticLine.browse(to_unlink).unlink()
+        ids_by_amount = defaultdict(list)
+        for timesheet in AnalyticLine.browse(list(amounts)):
+            if timesheet.unit_amount != amounts[timesheet.id]:
+                ids_by_amount[amounts[timesheet.id]].append(timesheet.id)
+        for unit_amount, ids in ids_by_amount.items():
+            AnalyticLine.browse(ids).write({'unit_amount': unit_amount})
+        for values in to_create:
+            AnalyticLine.create(values)
+        return counts
+
+    def _reconcile_matrix_cell(self, key, unit_amount, timesheets,
+                               amounts, to_unlink, to_create):
+        """Plan the changes needed for the timesheets of one cell to sum up
+        to ``unit_amount``: new quantities go to ``amounts``, timesheets to
+        delete to ``to_unlink`` and timesheets to create to ``to_create``.
+        Returns the number of timesheets of the cell after the changes."""
+        SheetLine = self.env['hr_timesheet.sheet.line']
+        count = len(timesheets)
+        if not count:
+            if unit_amount:
+                to_create.append(
+                    self._prepare_matrix_timesheet(key, unit_amount))
+                return 1
+            return 0
+        new_ts = timesheets.filtered(lambda t: t.name == '/')
+        other_ts = timesheets - new_ts
+        if not unit_amount:
+            to_unlink.extend(new_ts.ids)
+            amounts.update(dict.fromkeys(other_ts.ids, 0.0))
+            return len(other_ts)
+        if count == 1:
+            amounts[timesheets.id] = unit_amount
+            return count
+        diff_amount = unit_amount - sum(timesheets.mapped('unit_amount'))
+        if new_ts:
+            if len(new_ts) > 1:
+                count -= len(new_ts) - 1
+                new_ts = new_ts.merge_timesheets()
+            if new_ts.unit_amount + diff_amount >= 0.0:
+                if new_ts.unit_amount + diff_amount:
+                    amounts[new_ts.id] = new_ts.unit_amount + diff_amount
                 else:
-                    check = not all([l.unit_amount for l in row])
-                if check:
-                    ts_row.filtered(
-                        lambda t: t.name == '/' and not t.unit_amount).unlink()
+                    to_unlink.append(new_ts.id)
+                    count -= 1
+            else:
+                to_unlink.append(new_ts.id)
+                count -= 1
+                amounts.update(SheetLine._get_diff_amount_values(
+                    unit_amount - new_ts.unit_amount, other_ts))
+        elif diff_amount > 0.0:
+            to_create.append(
+                self._prepare_matrix_timesheet(key, diff_amount))
+            count += 1
+        else:
+            amounts.update(SheetLine._get_diff_amount_values(
+                unit_amount, other_ts))
+        return count
+
+    def _prepare_matrix_timesheet(self, key, amount):
+        date, project_id, task_id = key
+        return {
+            'name': '/',
+            'employee_id': self.employee_id.id,
+            'date': date,
+            'project_id': project_id,
+            'task_id': task_id,
+            'sheet_id': self.id,
+            'unit_amount': amount,
+            'company_id': self.company_id.id,
+        }
+
+    @api.multi
+    def delete_empty_lines(self, allow_empty_rows=False):
+        """Remove the empty '/' lines of the rows of the sheets that are not
+        worth keeping, for all the sheets at once and without computing
+        their matrix. A row is cleaned up when it has at least one empty
+        day or, with ``allow_empty_rows`` while a project is being added,
+        when it has at least one filled day."""
+        sheets = self.filtered(lambda s: s.id and s.state == 'draft')
+        if not sheets:
+            return
+        self.env.cr.execute("""
+            WITH sheet_line AS (
+                SELECT s.id AS sheet_id, s.date_start, s.date_end,
+                    s.add_line_project_id, l.id, l.name, l.date,
+                    l.project_id, l.task_id,
+                    COALESCE(l.unit_amount, 0) AS unit_amount
+                FROM hr_timesheet_sheet s
+                JOIN account_analytic_line l
+                    ON l.employee_id = s.employee_id
+                    AND l.company_id IS NOT DISTINCT FROM s.company_id
+                    AND l.date BETWEEN s.date_start AND s.date_end
+                    AND (l.sheet_id = s.id OR l.sheet_id IS NULL)
+                WHERE s.id IN %(sheet_ids)s
+                    AND l.project_id IS NOT NULL
+            ), cell AS (
+                SELECT sheet_id, project_id, task_id, date,
+                    SUM(unit_amount) AS unit_amount
+                FROM sheet_line
+                GROUP BY sheet_id, project_id, task_id, date
+            ), row_to_clean AS (
+                SELECT c.sheet_id, c.project_id, c.task_id
+                FROM cell c
+                JOIN hr_timesheet_sheet s ON s.id = c.sheet_id
+                GROUP BY c.sheet_id, c.project_id, c.task_id,
+                    s.date_start, s.date_end, s.add_line_project_id
+                HAVING CASE
+                    WHEN %(allow_empty_rows)s
+                        AND s.add_line_project_id IS NOT NULL
+                    THEN bool_or(c.unit_amount != 0)
+                    ELSE SUM(CASE WHEN c.unit_amount != 0 THEN 1 ELSE 0 END)
+                        < s.date_end - s.date_start + 1
+                    END
+            )
+            SELECT l.id
+            FROM sheet_line l
+            JOIN row_to_clean r
+                ON r.sheet_id = l.sheet_id
+                AND r.project_id = l.project_id
+                AND r.task_id IS NOT DISTINCT FROM l.task_id
+            WHERE l.name = '/' AND l.unit_amount = 0""", {
+            'sheet_ids': tuple(sheets.ids),
+            'allow_empty_rows': bool(allow_empty_rows),
+        })
+        line_ids = [r[0] for r in self.env.cr.fetchall()]
+        self.env['account.analytic.line'].browse(line_ids).unlink()
 
     # ------------------------------------------------
     # OpenChatter methods and notifications
@@ -554,6 +1201,83 @@ class SheetLine(models.TransientModel):
         default=0,
     )
 
+    @api.model
+    def _create_bulk(self, vals_list):
+        """Create the given cells with multi-row INSERT statements instead
+        of one create per cell. Cells are plain transient values, so the
+        ORM create machinery is not needed: the defaults of the stored
+        fields are applied, but overrides of ``create`` are not called."""
+        if not vals_list:
+            return self.browse()
+        self.check_access_rights('create')
+        defaults = {
+            name: value
+            for name, value in self.default_get(list(self._fields)).items()
+            if self._fields[name].store and
+            self._fields[name].column_type and
+            name not in models.MAGIC_COLUMNS
+        }
+        vals_list = [dict(defaults, **vals) for vals in vals_list]
+        columns = sorted(set().union(*vals_list))
+        row = "({}, %s, %s, now() at time zone 'UTC', " \
+              "now() at time zone 'UTC')".format(
+                  ', '.join(['%s'] * len(columns)))
+        ids = []
+        for chunk in split_every(1000, vals_list):
+            params = []
+            for vals in chunk:
+                params.extend(
+                    self._fields[column].convert_to_column(
+                        vals.get(column), self)
+                    for column in columns)
+                params.extend([self._uid, self._uid])
+            self.env.cr.execute("""
+                INSERT INTO "{}" ({}, create_uid, write_uid,
+                                  create_date, write_date)
+                VALUES {}
+                RETURNING id""".format(
+                self._table,
+                ', '.join('"{}"'.format(column) for column in columns),
+                ', '.join([row] * len(chunk)),
+            ), params)
+            ids.extend(r[0] for r in self.env.cr.fetchall())
+        return self.browse(ids)
+
+    @api.multi
+    def _get_matrix_key(self):
+        self.ensure_one()
+        return self.date, self.project_id.id, self.task_id.id or False
+
+    @api.multi
+    def _update_or_create(self, vals_list):
+        """Reuse the cells in ``self`` matching the given values, writing
+        only what changed, and create the missing ones in bulk.
+        Returns the cells in the order of ``vals_list``."""
+        existing = {line._get_matrix_key(): line
+                    for line in self.filtered('id').exists()}
+        lines = []
+        to_create = []
+        for vals in vals_list:
+            key = vals['date'], vals['project_id'], vals['task_id']
+            line = existing.pop(key, None)
+            if line is None:
+                lines.append(None)
+                to_create.append(vals)
+                continue
+            changes = {
+                name: value for name, value in vals.items()
+                if line._fields[name].convert_to_write(
+                    line[name], line) != value
+            }
+            if changes:
+                line.write(changes)
+            lines.append(line.id)
+        created = iter(self._create_bulk(to_create).ids)
+        return self.browse([
+            line_id if line_id is not None else next(created)
+            for line_id in lines
+        ])
+
     @api.onchange('unit_amount')
     def onchange_unit_amount(self):
         """This method is called when filling a cell of the matrix.
@@ -563,63 +1287,17 @@ class SheetLine(models.TransientModel):
         self.ensure_one()
         if self.unit_amount < 0.0:
             self.write({'unit_amount': 0.0})
-        if self.unit_amount and not self.count_timesheets:
-            self._create_timesheet(self.unit_amount)
-        elif self.count_timesheets:
-            task = self.task_id and self.task_id.id or False
-            timesheets = self.env['account.analytic.line'].search([
-                ('project_id', '=', self.project_id.id),
-                ('task_id', '=', task),
-                ('date', '=', self.date),
-                ('employee_id', '=', self.sheet_id.employee_id.id),
-                ('sheet_id', '=', self.sheet_id.id),
-                ('company_id', '=', self.sheet_id.company_id.id),
-            ])
-            if len(timesheets) != self.count_timesheets:
-                _logger.info('Found timesheets %s, expected %s',
-                             len(timesheets), self.count_timesheets)
-                self.count_timesheets = len(timesheets)
-            if not self.unit_amount:
-                new_ts = timesheets.filtered(lambda t: t.name == '/')
-                other_ts = timesheets.filtered(lambda t: t.name != '/')
-                if new_ts:
-                    new_ts.unlink()
-                for timesheet in other_ts:
-                    timesheet.write({'unit_amount': 0.0})
-                self.count_timesheets = len(other_ts)
-            else:
-                if self.count_timesheets == 1:
-                    timesheets.write({'unit_amount': self.unit_amount})
-                elif self.count_timesheets > 1:
-                    amount = sum([t.unit_amount for t in timesheets])
-                    new_ts = timesheets.filtered(lambda t: t.name == '/')
-                    other_ts = timesheets.filtered(lambda t: t.name != '/')
-                    diff_amount = self.unit_amount - amount
-                    if new_ts:
-                        if len(new_ts) > 1:
-                            new_ts = new_ts.merge_timesheets()
-                            self.count_timesheets = len(
-                                self.sheet_id.timesheet_ids)
-                        if new_ts.unit_amount + diff_amount >= 0.0:
-                            new_ts.unit_amount += diff_amount
-                            if not new_ts.unit_amount:
-                                new_ts.unlink()
-                                self.count_timesheets -= 1
-                        else:
-                            amount = self.unit_amount - new_ts.unit_amount
-                            new_ts.write({'unit_amount': 0.0})
-                            new_ts.unlink()
-                            self.count_timesheets -= 1
-                            self._diff_amount_timesheets(amount, other_ts)
-                    else:
-                        if diff_amount > 0.0:
-                            self._create_timesheet(diff_amount)
-                        else:
-                            amount = self.unit_amount
-                            self._diff_amount_timesheets(amount, other_ts)
-                else:
-                    raise ValidationError(
-                        _('Error code: Cannot have 0 timesheets.'))
+        if not self.unit_amount and not self.count_timesheets:
+            return
+        if not self.sheet_id:
+            # cell of an unsaved sheet
+            if self.unit_amount and not self.count_timesheets:
+                self._create_timesheet(self.unit_amount)
+            return
+        key = self._get_matrix_key()
+        counts = self.sheet_id.apply_matrix_edits(
+            [key + (self.unit_amount,)])
+        self.count_timesheets = counts[key]
 
     def _create_timesheet(self, amount):
         values = self._line_to_timesheet(amount)
@@ -627,26 +1305,27 @@ class SheetLine(models.TransientModel):
             self.count_timesheets += 1
 
     @api.model
-    def _diff_amount_timesheets(self, amount, timesheets):
+    def _get_diff_amount_values(self, amount, timesheets):
+        """Return the new quantities of ``timesheets``, by id, once
+        ``amount`` has been deducted from them in order."""
+        values = OrderedDict()
         for timesheet in timesheets:
             diff_amount = timesheet.unit_amount - amount
             if diff_amount >= 0.0:
-                timesheet.unit_amount = diff_amount
+                values[timesheet.id] = diff_amount
                 break
             else:
                 amount -= timesheet.unit_amount
-                timesheet.write({'unit_amount': 0.0})
+                values[timesheet.id] = 0.0
+        return values
+
+    @api.model
+    def _diff_amount_timesheets(self, amount, timesheets):
+        values = self._get_diff_amount_values(amount, timesheets)
+        for timesheet in timesheets.filtered(lambda t: t.id in values):
+            timesheet.write({'unit_amount': values[timesheet.id]})
 
     @api.model
     def _line_to_timesheet(self, amount):
-        task = self.task_id.id if self.task_id else False
-        return {
-            'name': '/',
-            'employee_id': self.sheet_id.employee_id.id,
-            'date': self.date,
-            'project_id': self.project_id.id,
-            'task_id': task,
-            'sheet_id': self.sheet_id.id,
-            'unit_amount': amount,
-            'company_id': self.sheet_id.company_id.id,
-        }
+        return self.sheet_id._prepare_matrix_timesheet(
+            self._get_matrix_key(), amount)
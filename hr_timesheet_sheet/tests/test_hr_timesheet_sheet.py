@@ -508,3 +508,610 @@ class TestHrTimesheetSheet(TransactionCase):
                                           "Sunday")
 
         self.assertEqual(weekday_to, 5, "The timesheet should end on Saturday")
+
+    def test_11_matrix_rows(self):
+        timesheet_1 = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'task_id': self.task_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 2.0,
+        })
+        self.aal_model.create({
+            'name': 'y',
+            'project_id': self.project_1.id,
+            'task_id': self.task_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 1.0,
+        })
+        self.aal_model.create({
+            'name': 'z',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 3.0,
+        })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        self.assertEqual(len(sheet.timesheet_ids), 3)
+        self.assertEqual(len(sheet.line_ids), 14)
+        self.assertEqual(
+            len(set(sheet.line_ids.mapped('value_y'))), 2)
+        line = sheet.line_ids.filtered(
+            lambda l: l.task_id == self.task_1 and
+            l.date == timesheet_1.date)
+        self.assertEqual(line.count_timesheets, 2)
+        self.assertEqual(line.unit_amount, 3.0)
+
+    def test_12_matrix_confirmed_sheet(self):
+        self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 2.0,
+        })
+        self.aal_model.create({
+            'name': 'y',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 1.5,
+        })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        sheet.action_timesheet_confirm()
+        data = sheet._get_timesheet_matrix_data()
+        self.assertEqual(list(data.values()), [(3.5, 2)])
+        sheet._compute_line_ids()
+        self.assertEqual(len(sheet.line_ids), 7)
+        line = sheet.line_ids.filtered(lambda l: l.unit_amount)
+        self.assertEqual(line.unit_amount, 3.5)
+        self.assertEqual(line.count_timesheets, 2)
+
+    def test_13_matrix_window(self):
+        for project in (self.project_1, self.project_2):
+            self.aal_model.create({
+                'name': 'x',
+                'project_id': project.id,
+                'employee_id': self.employee.id,
+                'unit_amount': 1.0,
+            })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        res = sheet.read_matrix_window(
+            row_offset=1, row_limit=1, date_offset=2, date_limit=3)
+        self.assertEqual(res['row_count'], 2)
+        self.assertEqual(res['date_count'], 7)
+        self.assertEqual(len(res['lines']), 3)
+        self.assertEqual(len(set(l['value_y'] for l in res['lines'])), 1)
+        self.assertEqual(
+            [l['date'] for l in res['lines']], sheet._get_dates()[2:5])
+        self.assertFalse(self.env['hr_timesheet.sheet.line'].search(
+            [('sheet_id', '=', sheet.id)]))
+
+    def test_14_matrix_delta(self):
+        timesheet_1 = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 1.0,
+        })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        lines = sheet.line_ids
+        self.assertEqual(len(lines), 7)
+
+        timesheet_1.unit_amount = 2.0
+        key = sheet._get_matrix_key(
+            timesheet_1.date, self.project_1, self.env['project.task'])
+        values, dropped_rows = sheet._get_matrix_delta(lines, {key})
+        self.assertEqual(len(values), 1)
+        self.assertEqual(values[0]['unit_amount'], 2.0)
+        self.assertFalse(dropped_rows)
+
+        timesheet_2 = self.aal_model.create({
+            'name': 'y',
+            'project_id': self.project_2.id,
+            'task_id': self.task_2.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 1.0,
+        })
+        key = sheet._get_matrix_key(
+            timesheet_2.date, self.project_2, self.task_2)
+        values, dropped_rows = sheet._get_matrix_delta(lines, {key})
+        self.assertEqual(len(values), 7)
+        self.assertFalse(dropped_rows)
+
+    def test_15_apply_matrix_edits(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        dates = sheet._get_dates()
+        counts = sheet.apply_matrix_edits([
+            (dates[0], self.project_1.id, False, 2.0),
+            (dates[1], self.project_1.id, False, 3.0),
+            (dates[1], self.project_2.id, self.task_2.id, 1.0),
+            (dates[2], self.project_2.id, self.task_2.id, 0.0),
+        ])
+        self.assertEqual(counts[(dates[0], self.project_1.id, False)], 1)
+        self.assertEqual(
+            counts[(dates[1], self.project_2.id, self.task_2.id)], 1)
+        self.assertEqual(
+            counts[(dates[2], self.project_2.id, self.task_2.id)], 0)
+        self.assertEqual(len(sheet.timesheet_ids), 3)
+        self.assertEqual(sheet.total_time, 6.0)
+
+        counts = sheet.apply_matrix_edits([
+            (dates[0], self.project_1.id, False, 0.0),
+            (dates[1], self.project_1.id, False, 1.0),
+        ])
+        self.assertEqual(counts[(dates[0], self.project_1.id, False)], 0)
+        self.assertEqual(counts[(dates[1], self.project_1.id, False)], 1)
+        self.assertEqual(len(sheet.timesheet_ids), 2)
+        self.assertEqual(sheet.total_time, 2.0)
+
+    def test_16_search_sheet(self):
+        timesheet = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+            'unit_amount': 1.0,
+        })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        self.assertIn(timesheet, self.aal_model.search(
+            [('sheet_id_computed', 'in', [sheet.id])]))
+        self.assertIn(timesheet, self.aal_model.search(
+            [('sheet_id_computed', '=', sheet.id)]))
+        self.assertNotIn(timesheet, self.aal_model.search(
+            [('sheet_id_computed', 'not in', [sheet.id])]))
+        self.assertNotIn(timesheet, self.aal_model.search(
+            [('sheet_id_computed', '=', False)]))
+        self.assertFalse(self.aal_model.search(
+            [('sheet_id_computed', 'in', [])]))
+
+    def test_17_generate_sheets(self):
+        employee_2 = self.employee_model.create({
+            'name': "Test User 2",
+            'user_id': self.user_2.id,
+            'company_id': self.user_2.company_id.id,
+        })
+        employee_3 = self.employee_model.create({
+            'name': "Test Employee without user",
+        })
+        employee_4 = self.employee_model.create({
+            'name': "Test Employee without company",
+            'user_id': self.env.user.id,
+            'company_id': False,
+        })
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        employees = self.employee | employee_2 | employee_3 | employee_4
+        sheet_model = self.sheet_model.sudo(self.user)
+        sheets = sheet_model.generate_sheets(employees)
+        self.assertEqual(sheets.mapped('employee_id'), employee_2)
+        self.assertEqual(sheets.company_id, employee_2.company_id)
+        self.assertFalse(sheet_model.generate_sheets(employees))
+
+        date = fields.Date.to_string(
+            fields.Date.from_string(sheet.date_end) + relativedelta(days=1))
+        sheets = sheet_model.generate_sheets(employees, date=date)
+        self.assertEqual(len(sheets), 2)
+        self.assertEqual(set(sheets.mapped('date_start')), {date})
+
+    def test_18_write_cleanup(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        sheet.add_line_project_id = self.project_1
+        sheet.sudo(self.user).button_add_line()
+        self.assertEqual(len(sheet.timesheet_ids), 1)
+        sheet.name = 'Note'
+        self.assertTrue(sheet.timesheet_ids.exists())
+        sheet.date_end = sheet.date_end
+        self.assertFalse(sheet.timesheet_ids.exists())
+
+    def test_19_total_time(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheet = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 2.0,
+        })
+        self.assertEqual(sheet.total_time, 2.0)
+        timesheet.unit_amount = 3.5
+        self.assertEqual(sheet.total_time, 3.5)
+
+        self.env.cr.execute(
+            "UPDATE hr_timesheet_sheet SET total_time = 0 WHERE id = %s",
+            (sheet.id,))
+        self.sheet_model.rebuild_total_time([sheet.id])
+        self.assertEqual(sheet.total_time, 3.5)
+
+    def test_20_protected_fields(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheet = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 2.0,
+        })
+        sheet.action_timesheet_confirm()
+        timesheet.amount = -20.0
+        self.assertEqual(timesheet.amount, -20.0)
+        with self.assertRaises(UserError):
+            timesheet.unit_amount = 1.0
+        with self.assertRaises(UserError):
+            timesheet.unlink()
+
+    def test_21_sheet_state(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheet = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 2.0,
+        })
+        self.assertEqual(timesheet.sheet_state, 'draft')
+        sheet.action_timesheet_confirm()
+        self.assertEqual(timesheet.sheet_state, 'confirm')
+        sheet.action_timesheet_done()
+        self.assertEqual(timesheet.sheet_state, 'done')
+        self.assertEqual(self.aal_model.search_count([
+            ('id', '=', timesheet.id),
+            ('sheet_state', '=', 'done'),
+        ]), 1)
+        sheet.action_timesheet_draft()
+        self.assertEqual(timesheet.sheet_state, 'draft')
+
+    def test_22_unlink(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheet_1 = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 2.0,
+        })
+        timesheet_2 = self.aal_model.create({
+            'name': 'y',
+            'project_id': self.project_1.id,
+            'task_id': self.task_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'unit_amount': 1.0,
+        })
+        sheet.unlink()
+        self.assertFalse(timesheet_1.exists())
+        self.assertTrue(timesheet_2.exists())
+
+    def test_23_merge_sheet_timesheets(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheets = self.aal_model.browse()
+        for unit_amount in (1.0, 2.0, 3.0):
+            timesheets |= self.aal_model.create({
+                'name': '/',
+                'project_id': self.project_1.id,
+                'employee_id': self.employee.id,
+                'sheet_id': sheet.id,
+                'date': sheet.date_start,
+                'unit_amount': unit_amount,
+            })
+        other = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'sheet_id': sheet.id,
+            'date': sheet.date_start,
+            'unit_amount': 4.0,
+        })
+        merged = self.aal_model.merge_sheet_timesheets(sheet)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged.unit_amount, 6.0)
+        self.assertEqual(len(timesheets.exists()), 1)
+        self.assertTrue(other.exists())
+        self.assertEqual(sheet.total_time, 10.0)
+
+    def test_24_adopt_orphan_timesheets(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        date = fields.Date.to_string(
+            fields.Date.from_string(sheet.date_end) + relativedelta(days=1))
+        timesheet_1 = self.aal_model.create({
+            'name': '/',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'date': date,
+            'unit_amount': 1.0,
+        })
+        timesheet_2 = self.aal_model.create({
+            'name': '/',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'date': date,
+            'unit_amount': 2.0,
+        })
+        self.assertFalse(timesheet_1.sheet_id)
+
+        sheet.date_end = date
+        self.assertEqual(len(sheet.timesheet_ids), 1)
+        self.assertEqual(len((timesheet_1 | timesheet_2).exists()), 1)
+        self.assertEqual(sheet.timesheet_ids.unit_amount, 3.0)
+        self.assertEqual(sheet.total_time, 3.0)
+
+        timesheet_3 = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'date': date,
+            'unit_amount': 1.0,
+        })
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET sheet_id = NULL WHERE id = %s",
+            (timesheet_3.id,))
+        timesheet_3.invalidate_cache(['sheet_id'], timesheet_3.ids)
+        # rendering the matrix does not link the timesheets
+        sheet._compute_line_ids()
+        self.assertFalse(timesheet_3.sheet_id)
+        self.sheet_model._cron_adopt_orphan_timesheets()
+        self.assertEqual(timesheet_3.sheet_id, sheet)
+
+    def test_25_unsaved_sheet_cell(self):
+        self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'unit_amount': 1.0,
+        })
+        sheet = self.sheet_model.sudo(self.user).new({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+            'date_start': self.sheet_model._default_date_start(),
+            'date_end': self.sheet_model._default_date_end(),
+        })
+        sheet._onchange_dates_or_timesheets()
+        self.assertEqual(len(sheet.line_ids), 7)
+        line = sheet.line_ids.filtered(lambda l: not l.count_timesheets)[0]
+        self.assertFalse(line.sheet_id)
+        line._cache.update(
+            line._convert_to_cache(
+                {'unit_amount': 2.0}, update=True))
+        line.onchange_unit_amount()
+        self.assertEqual(line.count_timesheets, 1)
+
+    def test_26_company_error_lists_all(self):
+        employee_3 = self.employee_model.create({
+            'name': "Test User 3",
+            'user_id': self.user_2.id,
+            'company_id': self.user.company_id.id,
+        })
+        department_3 = self.department_model.create({
+            'name': "Department test 3",
+            'company_id': self.user.company_id.id,
+        })
+        self.sheet_model.create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+            'department_id': self.department.id,
+        })
+        self.sheet_model.create({
+            'employee_id': employee_3.id,
+            'company_id': self.user.company_id.id,
+            'department_id': department_3.id,
+        })
+        employees = self.employee | employee_3
+        with self.assertRaises(ValidationError) as cm:
+            employees.write({'company_id': self.user_2.company_id.id})
+        self.assertEqual(len(cm.exception.name.splitlines()), 2)
+        for employee in employees:
+            self.assertIn(employee.name, cm.exception.name)
+        departments = self.department | department_3
+        with self.assertRaises(ValidationError) as cm:
+            departments.write({'company_id': self.user_2.company_id.id})
+        self.assertEqual(len(cm.exception.name.splitlines()), 2)
+        for department in departments:
+            self.assertIn(department.name, cm.exception.name)
+
+    def test_27_apply_matrix_edits_orphan(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        timesheet = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'date': sheet.date_start,
+            'unit_amount': 1.0,
+        })
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET sheet_id = NULL WHERE id = %s",
+            (timesheet.id,))
+        timesheet.invalidate_cache(['sheet_id'], timesheet.ids)
+        key = (sheet.date_start, self.project_1.id, False)
+        counts = sheet.apply_matrix_edits([key + (3.0,)])
+        self.assertEqual(counts[key], 1)
+        self.assertEqual(timesheet.sheet_id, sheet)
+        self.assertEqual(timesheet.unit_amount, 3.0)
+
+    def test_28_onchange_matrix_delta(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        dates = sheet._get_dates()
+        timesheet_1 = self.aal_model.create({
+            'name': 'x',
+            'project_id': self.project_1.id,
+            'employee_id': self.employee.id,
+            'date': dates[0],
+            'unit_amount': 1.0,
+        })
+        timesheet_2 = self.aal_model.create({
+            'name': 'y',
+            'project_id': self.project_2.id,
+            'employee_id': self.employee.id,
+            'date': dates[0],
+            'unit_amount': 2.0,
+        })
+        lines = sheet.line_ids
+        self.assertEqual(len(lines), 14)
+
+        def timesheet_command(timesheet, **changes):
+            values = {
+                'name': timesheet.name,
+                'date': timesheet.date,
+                'project_id': timesheet.project_id.id,
+                'task_id': timesheet.task_id.id,
+                'unit_amount': timesheet.unit_amount,
+                'user_id': timesheet.user_id.id,
+            }
+            values.update(changes)
+            return 1, timesheet.id, values
+
+        # the cell of timesheet_1 changes, and timesheet_2 moves from the
+        # row of project 2 to a new row for task 2
+        values = {
+            'employee_id': sheet.employee_id.id,
+            'company_id': sheet.company_id.id,
+            'date_start': sheet.date_start,
+            'date_end': sheet.date_end,
+            'state': sheet.state,
+            'timesheet_ids': [
+                timesheet_command(timesheet_1, unit_amount=3.0),
+                timesheet_command(timesheet_2, task_id=self.task_2.id),
+            ],
+            'line_ids': [(4, line.id) for line in lines],
+        }
+        result = sheet.onchange(
+            values, 'timesheet_ids', sheet._onchange_spec())
+
+        def get_id(value):
+            if isinstance(value, (list, tuple)):
+                return value[0]
+            return value or False
+
+        cells = {}
+        for command in result['value']['line_ids']:
+            if command[0] not in (0, 1):
+                continue
+            vals = command[2]
+            key = (vals['date'], get_id(vals['project_id']),
+                   get_id(vals['task_id']))
+            cells[key] = vals['unit_amount']
+        self.assertEqual(len(cells), 14)
+        self.assertEqual(cells[(dates[0], self.project_1.id, False)], 3.0)
+        self.assertEqual(
+            cells[(dates[0], self.project_2.id, self.task_2.id)], 2.0)
+        for date in dates:
+            self.assertIn((date, self.project_2.id, self.task_2.id), cells)
+            self.assertNotIn((date, self.project_2.id, False), cells)
+
+    def test_29_apply_matrix_edits_checks(self):
+        sheet = self.sheet_model.sudo(self.user).create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        date = fields.Date.to_string(
+            fields.Date.from_string(sheet.date_end) + relativedelta(days=1))
+        with self.assertRaises(UserError):
+            sheet.apply_matrix_edits([
+                (date, self.project_1.id, False, 1.0),
+            ])
+        sheet.action_timesheet_confirm()
+        with self.assertRaises(UserError):
+            sheet.apply_matrix_edits([
+                (sheet.date_start, self.project_1.id, False, 1.0),
+            ])
+        self.assertFalse(sheet.timesheet_ids)
+
+    def test_30_compute_sheet_batch(self):
+        employee_2 = self.employee_model.create({
+            'name': "Test User 2",
+            'user_id': self.user_2.id,
+            'company_id': self.user_2.company_id.id,
+        })
+        project_3 = self.project_model.create({
+            'name': "Project 3",
+            'company_id': self.user_2.company_id.id,
+            'allow_timesheets': True,
+        })
+        project_4 = self.project_model.create({
+            'name': "Project 4",
+            'company_id': False,
+            'allow_timesheets': True,
+        })
+        sheet_1 = self.sheet_model.create({
+            'employee_id': self.employee.id,
+            'company_id': self.user.company_id.id,
+        })
+        sheet_2 = self.sheet_model.create({
+            'employee_id': employee_2.id,
+            'company_id': self.user_2.company_id.id,
+        })
+        sheet_3 = self.sheet_model.create({
+            'employee_id': self.employee.id,
+            'company_id': False,
+        })
+        dates = sheet_1._get_dates()
+        next_date = fields.Date.to_string(
+            fields.Date.from_string(sheet_1.date_end) + relativedelta(days=1))
+        expected = {}
+        for employee, project, date, sheet in [
+                (self.employee, self.project_1, dates[0], sheet_1),
+                (self.employee, self.project_1, dates[1], sheet_1),
+                (employee_2, project_3, dates[0], sheet_2),
+                (self.employee, project_4, dates[2], sheet_3),
+                (self.employee, self.project_1, next_date, False)]:
+            timesheet = self.aal_model.create({
+                'name': 'x',
+                'project_id': project.id,
+                'employee_id': employee.id,
+                'date': date,
+            })
+            expected[timesheet] = sheet
+        timesheets = self.aal_model.browse([t.id for t in expected])
+        self.assertFalse(timesheets[3].company_id)
+
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET sheet_id = NULL WHERE id IN %s",
+            (tuple(timesheets.ids),))
+        timesheets.invalidate_cache(['sheet_id'], timesheets.ids)
+        timesheets._compute_sheet()
+        for timesheet, sheet in expected.items():
+            self.assertEqual(timesheet.sheet_id, sheet or self.sheet_model)
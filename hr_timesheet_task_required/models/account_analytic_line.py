@@ -14,7 +14,30 @@ class AccountAnalyticLine(models.Model):
         'task_id',
     )
     def _check_timesheet_task(self):
-        for rec in self:
-            if rec.project_id and not rec.task_id:
-                raise ValidationError(_(
-                    "You must specify a task for timesheet lines."))
+        line_ids = []
+        for sub_ids in self.env.cr.split_for_in_conditions(self.ids):
+            self.env.cr.execute("""
+                SELECT id
+                FROM account_analytic_line
+                WHERE id IN %s
+                    AND project_id IS NOT NULL
+                    AND task_id IS NULL
+                ORDER BY id""", (sub_ids,))
+            line_ids += [r[0] for r in self.env.cr.fetchall()]
+        if line_ids:
+            raise ValidationError(
+                _("You must specify a task for timesheet lines.") + '\n' +
+                _("Lines without task: %s") % ', '.join(map(str, line_ids)))
+
+    @api.model
+    def check_timesheet_task_values(self, vals_list):
+        """Check a batch of values before creating or importing them, and
+        report every row with a project but no task at once."""
+        rows = [
+            index for index, vals in enumerate(vals_list, 1)
+            if vals.get('project_id') and not vals.get('task_id')
+        ]
+        if rows:
+            raise ValidationError(
+                _("You must specify a task for timesheet lines.") + '\n' +
+                _("Rows without task: %s") % ', '.join(map(str, rows)))
@@ -37,3 +37,34 @@ class TestHrTimesheetTaskRequired(SavepointCase):
             'unit_amount': 10,
         })
         self.assertTrue(bool(line))
+
+    def test_timesheet_line_task_required_batch(self):
+        line_1 = self.AnalyticLine.create({
+            'name': "test 1",
+            'project_id': self.project_1.id,
+            'task_id': self.task_1_p1.id,
+        })
+        line_2 = self.AnalyticLine.create({
+            'name': "test 2",
+            'project_id': self.project_1.id,
+            'task_id': self.task_1_p1.id,
+        })
+        with self.assertRaises(ValidationError) as err:
+            (line_1 | line_2).write({'task_id': False})
+        self.assertIn(str(line_1.id), err.exception.name)
+        self.assertIn(str(line_2.id), err.exception.name)
+
+    def test_check_timesheet_task_values(self):
+        values = [{
+            'name': "test 1",
+            'project_id': self.project_1.id,
+            'task_id': self.task_1_p1.id,
+        }, {
+            'name': "test 2",
+            'project_id': self.project_1.id,
+        }]
+        with self.assertRaises(ValidationError) as err:
+            self.AnalyticLine.check_timesheet_task_values(values)
+        self.assertIn('Rows without task: 2', err.exception.name)
+        self.assertNotIn('1, ', err.exception.name)
+        self.AnalyticLine.check_timesheet_task_values(values[:1])
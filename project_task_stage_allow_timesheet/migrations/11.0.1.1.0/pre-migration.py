@@ -0,0 +1,18 @@
+# Copyright 2018 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo.tools.sql import column_exists, create_column
+
+
+def migrate(cr, version):
+    """Fill the new stored stage_allow_timesheet column in SQL, so that
+    the ORM does not recompute it task by task."""
+    if not version:
+        return
+    if not column_exists(cr, 'project_task', 'stage_allow_timesheet'):
+        create_column(cr, 'project_task', 'stage_allow_timesheet', 'boolean')
+    cr.execute("""
+        UPDATE project_task t
+        SET stage_allow_timesheet = s.allow_timesheet
+        FROM project_task_type s
+        WHERE s.id = t.stage_id""")
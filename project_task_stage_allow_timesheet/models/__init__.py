@@ -1,2 +1,3 @@
 from . import account_analytic_line
+from . import project_task
 from . import project_task_type
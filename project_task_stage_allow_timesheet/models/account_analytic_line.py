@@ -15,21 +15,38 @@ class AccountAnalyticLine(models.Model):
 
     @api.constrains('task_id')
     def _check_task_allow_timesheet(self):
-        for rec in self:
-            task = rec.task_id
-            stage = task.stage_id
-            if task and not stage.allow_timesheet:
-                raise ValidationError(_(
-                    "You can't link a timesheet line to a task if its stage "
-                    "doesn't allow it. (Task: %s, Stage: %s)"
-                ) % (
-                    task.display_name,
-                    stage.display_name,
-                ))
+        task_ids = self.mapped('task_id').ids
+        if not task_ids:
+            return
+        self.env.cr.execute("""
+            SELECT t.id, t.stage_id
+            FROM project_task t
+            LEFT JOIN project_task_type s ON s.id = t.stage_id
+            WHERE t.id IN %s
+                AND NOT COALESCE(s.allow_timesheet, FALSE)
+            ORDER BY t.id""", (tuple(task_ids),))
+        rows = self.env.cr.fetchall()
+        if not rows:
+            return
+        tasks = self.env['project.task'].browse([r[0] for r in rows])
+        stages = self.env['project.task.type'].browse(
+            [r[1] for r in rows if r[1]])
+        messages = []
+        for task_id, stage_id in rows:
+            task = tasks.browse(task_id).with_prefetch(tasks._prefetch)
+            stage = stages.browse(stage_id).with_prefetch(stages._prefetch)
+            messages.append(_(
+                "You can't link a timesheet line to a task if its stage "
+                "doesn't allow it. (Task: %s, Stage: %s)"
+            ) % (
+                task.display_name,
+                stage.display_name,
+            ))
+        raise ValidationError('\n'.join(messages))
 
     @api.model
     def _get_task_domain(self):
         return "[" \
                "('project_id', '=', project_id)," \
-               "('stage_id.allow_timesheet', '=', True)," \
+               "('stage_allow_timesheet', '=', True)," \
                "]"
@@ -0,0 +1,16 @@
+# Copyright 2018 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import fields, models
+
+
+class ProjectTask(models.Model):
+
+    _inherit = 'project.task'
+
+    stage_allow_timesheet = fields.Boolean(
+        related='stage_id.allow_timesheet',
+        string="Stage allows timesheets",
+        store=True,
+        index=True,
+    )
@@ -32,3 +32,38 @@ class TestProjectTaskStageAllowTimesheet(SavepointCase):
 
         self.stage_new.allow_timesheet = True
         self.AnalyticLine.create(values)
+
+    def test_02_task_stage_allow_timesheet(self):
+        self.task_1.stage_id = self.stage_new
+        self.stage_new.allow_timesheet = False
+        self.assertFalse(self.task_1.stage_allow_timesheet)
+        self.assertNotIn(self.task_1, self.env['project.task'].search(
+            [('stage_allow_timesheet', '=', True)]))
+
+        self.stage_new.allow_timesheet = True
+        self.assertTrue(self.task_1.stage_allow_timesheet)
+
+    def test_03_error_lists_all_tasks(self):
+        self.stage_new.allow_timesheet = True
+        self.task_1.stage_id = self.stage_new
+        task_2 = self.env['project.task'].create({
+            'name': "Test task 2",
+            'project_id': self.project_1.id,
+            'stage_id': self.stage_new.id,
+        })
+        lines = self.AnalyticLine.browse()
+        for task in self.task_1 | task_2:
+            lines |= self.AnalyticLine.create({
+                'name': "test",
+                'project_id': self.project_1.id,
+                'task_id': task.id,
+            })
+
+        # both lines are checked together, as after a write on both
+        self.stage_new.allow_timesheet = False
+        with self.assertRaises(ValidationError) as cm:
+            lines._check_task_allow_timesheet()
+        message = cm.exception.name
+        self.assertEqual(len(message.splitlines()), 2)
+        self.assertIn(self.task_1.display_name, message)
+        self.assertIn(task_2.display_name, message)